@@ -5,9 +5,15 @@ This module defines the Agent class which can send and receive messages
 over BLE and generate responses using a language model.
 """
 import asyncio
+import contextlib
+import copy
 import json
 import logging
-from typing import Dict, Any, Optional, Callable
+import random
+import re
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, Callable, Tuple
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -15,7 +21,8 @@ logger = logging.getLogger(__name__)
 
 # Import the transformers library for AI capabilities
 try:
-    from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
     from transformers.utils import logging as tf_logging
     tf_logging.set_verbosity_error()  # Reduce verbosity
     TRANSFORMERS_AVAILABLE = True
@@ -23,6 +30,325 @@ except ImportError:
     logger.warning("transformers library not found. AI features will be disabled.")
     TRANSFORMERS_AVAILABLE = False
 
+# Number of per-sender prompt prefixes whose KV cache is kept around
+PREFIX_CACHE_SIZE = 64
+
+# Number of conversation turns remembered per peer
+HISTORY_SIZE = 32
+
+# First line of generated text (after leading whitespace), at most 200 chars
+_FIRST_LINE = re.compile(r'\s*([^\n]{0,200})')
+
+# Canned replies about Toronto's weather for when generation fails
+_WEATHER_FALLBACKS = (
+    "I heard Toronto is experiencing seasonal temperatures today.",
+    "The weather in Toronto is always changing, isn't it?",
+    "I don't have the latest forecast, but I hope Toronto's weather is pleasant!",
+    "It's a beautiful day in Toronto, don't you think?",
+)
+
+
+def _cpu_supports_bf16() -> bool:
+    """Return True if the CPU has native BF16 matmul support (AVX512-BF16/AMX)."""
+    try:
+        return (torch.backends.mkldnn.is_available()
+                and torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+class _UpcastLogits:
+    """Logits processor that hands FP32 scores to the sampling warpers."""
+
+    def __call__(self, input_ids: Any, scores: Any) -> Any:
+        return scores.float()
+
+
+def _inference_context(use_bf16: bool) -> contextlib.ExitStack:
+    """Return a context for model forward passes (no autograd, optional BF16)."""
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    stack.enter_context(torch.autocast('cpu', dtype=torch.bfloat16, enabled=use_bf16))
+    return stack
+
+
+def _quantize_int8(model: Any) -> Any:
+    """
+    Quantize the weight GEMMs of a causal LM to INT8.
+
+    GPT-2 style models implement their projections with transformers'
+    ``Conv1D`` instead of ``nn.Linear``, so those layers are first swapped
+    for equivalent Linear layers. ``quantize_dynamic`` then packs every
+    Linear weight once at load time. The attention score matmuls are not
+    modules and stay in FP32.
+
+    Args:
+        model: A loaded HuggingFace model (modified in place)
+
+    Returns:
+        The quantized model
+    """
+    try:
+        from transformers.pytorch_utils import Conv1D
+    except ImportError:
+        from transformers.modeling_utils import Conv1D
+
+    conv_layers = [
+        (parent, name, child)
+        for parent in model.modules()
+        for name, child in parent.named_children()
+        if isinstance(child, Conv1D)
+    ]
+    for parent, name, conv in conv_layers:
+        # Conv1D stores its weight as (in_features, out_features)
+        linear = torch.nn.Linear(conv.weight.shape[0], conv.nf)
+        linear.weight.data = conv.weight.data.t().contiguous()
+        linear.bias.data = conv.bias.data
+        setattr(parent, name, linear)
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def _compile_forward(model: Any, use_bf16: bool) -> Any:
+    """
+    Compile a model's forward pass with ``torch.compile``.
+
+    Only ``forward`` is compiled, so ``generate`` and the rest of the
+    HuggingFace API keep working on the same object. Shapes are marked
+    dynamic because the sequence length grows by one every decoding step.
+
+    ``torch.compile`` only traces on the first call, so a short warm-up
+    pass runs here; if compiling fails (e.g. no C++ toolchain), the
+    eager forward is put back.
+
+    Args:
+        model: A loaded HuggingFace model (modified in place)
+        use_bf16: Whether the model runs under BF16 autocast
+
+    Returns:
+        The model, with its forward compiled if that works on this host
+    """
+    if not hasattr(torch, 'compile'):
+        logger.warning("torch.compile is not available; running the model eagerly")
+        return model
+    try:
+        model.forward = torch.compile(model.forward, dynamic=True)
+        with _inference_context(use_bf16):
+            model(torch.zeros((1, 2), dtype=torch.long), use_cache=True)
+    except Exception as e:
+        logger.warning("Could not compile model, running eagerly: %s", e)
+        # The compiled forward is an instance attribute; dropping it
+        # restores the class's own forward
+        model.__dict__.pop('forward', None)
+    return model
+
+
+def _cache_length(past_key_values: Any) -> int:
+    """Return the number of tokens held in a KV cache (legacy tuple or Cache object)."""
+    if hasattr(past_key_values, 'get_seq_length'):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].shape[-2]
+
+
+class _GenBatcher:
+    """
+    Coalesces concurrent generation requests for one model into batches.
+    
+    Requests arriving within ``max_wait`` seconds of each other are run
+    through a single left-padded ``model.generate`` call. A request that
+    ends up alone in its batch keeps its cached prompt prefix instead.
+    
+    The queue and worker belong to the event loop that last called
+    ``generate``; a new loop (e.g. a second ``asyncio.run``) gets fresh ones.
+    Use one loop at a time.
+    
+    All model work for the batcher's model, including prefix encoding,
+    runs under one lock, so calls from different agents never overlap.
+    """
+    
+    def __init__(self, model: Any, tokenizer: Any, use_bf16: bool,
+                 max_batch: int = 8, max_wait: float = 0.005):
+        """
+        Initialize the batcher.
+        
+        Args:
+            model: Model to generate with
+            tokenizer: Tokenizer matching the model
+            use_bf16: Whether to run generation under BF16 autocast
+            max_batch: Maximum number of prompts per generate call
+            max_wait: Seconds to wait for more prompts after the first one
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.use_bf16 = use_bf16
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pad_id = tokenizer.eos_token_id
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Held by whichever thread is running the model
+        self._model_lock = threading.Lock()
+    
+    async def generate(self, input_ids: Any, past_key_values: Any = None) -> Any:
+        """
+        Generate a continuation for a single prompt.
+        
+        Args:
+            input_ids: Prompt token IDs, shape (1, seq_len)
+            past_key_values: KV cache for a prefix of ``input_ids`` (optional)
+            
+        Returns:
+            Tensor of the newly generated token IDs
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Anything left from an earlier loop went down with it
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = None
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        
+        future = loop.create_future()
+        await self._queue.put((input_ids, past_key_values, future))
+        return await future
+    
+    async def encode_prefix(self, prefix_ids: Any) -> Any:
+        """
+        Run a prompt prefix through the model on a worker thread.
+        
+        Args:
+            prefix_ids: Prefix token IDs, shape (1, seq_len)
+            
+        Returns:
+            KV cache for the prefix
+        """
+        return await asyncio.to_thread(self._encode_prefix, prefix_ids)
+    
+    def _encode_prefix(self, prefix_ids: Any) -> Any:
+        """Return the KV cache for a prefix; runs on a worker thread."""
+        with self._model_lock, _inference_context(self.use_bf16):
+            return self.model(prefix_ids, use_cache=True).past_key_values
+    
+    async def close(self) -> None:
+        """Stop the worker; requests still queued or running are cancelled."""
+        worker, self._worker = self._worker, None
+        if worker is not None and not worker.done():
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            future.cancel()
+    
+    async def _run(self) -> None:
+        """Drain the request queue and generate one batch at a time."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                # Run on a worker thread; torch releases the GIL inside its
+                # kernels, so BLE I/O on the event loop keeps flowing
+                results = await asyncio.to_thread(
+                    self._generate_batch, [(ids, kv) for ids, kv, _ in batch]
+                )
+            except asyncio.CancelledError:
+                for _, _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    def _generate_batch(self, requests: list) -> list:
+        """
+        Run one generate call for a list of (input_ids, past_key_values) requests.
+        
+        Returns:
+            list: The new token IDs for each request, in order
+        """
+        with self._model_lock:
+            return self._generate_locked(requests)
+    
+    def _generate_locked(self, requests: list) -> list:
+        """Body of _generate_batch; the caller holds the model lock."""
+        pad_id = self.pad_id
+        if len(requests) == 1:
+            input_ids, past_key_values = requests[0]
+            attention_mask = torch.ones_like(input_ids)
+            if past_key_values is not None:
+                # generate() extends the cache in place, so hand it a copy
+                past_key_values = self._extend_cache(copy.deepcopy(past_key_values), input_ids)
+        else:
+            # Left-pad so every prompt ends where generation starts
+            seq_len = max(ids.shape[-1] for ids, _ in requests)
+            input_ids = torch.full((len(requests), seq_len), pad_id, dtype=torch.long)
+            attention_mask = torch.zeros_like(input_ids)
+            for row, (ids, _) in enumerate(requests):
+                input_ids[row, seq_len - ids.shape[-1]:] = ids[0]
+                attention_mask[row, seq_len - ids.shape[-1]:] = 1
+            past_key_values = None
+        
+        with _inference_context(self.use_bf16):
+            output_ids = self.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                max_new_tokens=60,
+                num_return_sequences=1,
+                temperature=0.8,  # Slightly higher for more creative responses
+                top_k=40,  # top_k alone avoids top_p's full-vocabulary sort
+                do_sample=True,
+                use_cache=True,
+                pad_token_id=pad_id,
+                logits_processor=[_UpcastLogits()]  # Sample in FP32
+            )
+        
+        prompt_len = input_ids.shape[-1]
+        return [output_ids[row, prompt_len:] for row in range(len(requests))]
+    
+    def _extend_cache(self, past_key_values: Any, input_ids: Any) -> Any:
+        """
+        Run the uncached part of a prompt, bar its last token, through the model.
+        
+        With a cache present, older transformers releases only feed the last
+        prompt token to the model and newer ones only the uncached tokens.
+        A cache that covers everything but the last token works with both.
+        
+        Args:
+            past_key_values: KV cache for a prefix of ``input_ids``
+            input_ids: Full prompt token IDs, shape (1, seq_len)
+            
+        Returns:
+            KV cache covering all of ``input_ids`` except the last token
+        """
+        cached = _cache_length(past_key_values)
+        if cached < input_ids.shape[-1] - 1:
+            with _inference_context(self.use_bf16):
+                past_key_values = self.model(
+                    input_ids[:, cached:-1], past_key_values=past_key_values, use_cache=True
+                ).past_key_values
+        return past_key_values
+
+
 class Agent:
     """
     An AI agent that can communicate over BLE.
@@ -31,7 +357,14 @@ class Agent:
     generating responses using a language model.
     """
     
-    def __init__(self, agent_id: str, communicator: Any, model_name: str = "distilgpt2"):
+    # Loaded (tokenizer, model, use_bf16, batcher) per (model name, compiled),
+    # shared by all agents in the process. Every model call goes through the
+    # batcher, which runs one at a time, so sharing is safe.
+    _MODEL_CACHE: Dict[Tuple[str, bool], Tuple[Any, Any, bool, _GenBatcher]] = {}
+    _MODEL_CACHE_LOCK = threading.Lock()
+    
+    def __init__(self, agent_id: str, communicator: Any, model_name: str = "distilgpt2",
+                 compile_model: bool = False):
         """
         Initialize a new agent.
         
@@ -39,13 +372,21 @@ class Agent:
             agent_id: Unique identifier for this agent
             communicator: BLECommunicator instance for message transport
             model_name: Name of the HuggingFace model to use (optional)
+            compile_model: Compile the model's forward pass with torch.compile.
+                Faster once warmed up, but loading the model takes longer
+                while it compiles (optional)
         """
         self.agent_id = agent_id
         self.communicator = communicator
         self.model_name = model_name
-        self.conversation_history: Dict[str, list] = {}
+        self.compile_model = compile_model
+        self.conversation_history: Dict[str, deque] = {}
         self.model = None
         self.tokenizer = None
+        self.use_bf16 = False
+        self._batcher: Optional[_GenBatcher] = None
+        self._static_prefix_ids = None
+        self._prefix_kv_cache: "OrderedDict[str, Tuple[Any, Any]]" = OrderedDict()
         self.message_handler = None
         
         # Initialize the AI model
@@ -57,28 +398,60 @@ class Agent:
     def _init_model(self) -> None:
         """Initialize the language model and tokenizer."""
         if not TRANSFORMERS_AVAILABLE:
-            print(f"[AGENT {self.agent_id}] Running in no-AI mode (transformers not available)")
+            logger.warning("[AGENT %s] Running in no-AI mode (transformers not available)", self.agent_id)
             return
             
         try:
-            print(f"[AGENT {self.agent_id}] Loading model '{self.model_name}'...")
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                pad_token_id=self.tokenizer.eos_token_id
-            )
-            self.generator = pipeline(
-                'text-generation',
-                model=self.model,
-                tokenizer=self.tokenizer,
-                device=-1  # Use CPU
-            )
-            print(f"[AGENT {self.agent_id}] Model loaded successfully")
+            # Agents in the same process share one copy of each model
+            with Agent._MODEL_CACHE_LOCK:
+                cache_key = (self.model_name, self.compile_model)
+                cached = Agent._MODEL_CACHE.get(cache_key)
+                if cached is None:
+                    logger.info("[AGENT %s] Loading model '%s'...", self.agent_id, self.model_name)
+                    cached = self._load_model(self.model_name, self.compile_model)
+                    Agent._MODEL_CACHE[cache_key] = cached
+            self.tokenizer, self.model, self.use_bf16, self._batcher = cached
+            
+            # The start of the prompt never changes for this agent, so it
+            # is tokenized once here
+            self._static_prefix_ids = self.tokenizer(
+                f"Conversation about Toronto's weather. {self.agent_id} is talking to",
+                return_tensors='pt'
+            ).input_ids
+            logger.info("[AGENT %s] Model loaded successfully", self.agent_id)
         except Exception as e:
-            print(f"[AGENT {self.agent_id}] Error loading model: {e}")
-            print("[AGENT {self.agent_id}] Falling back to echo mode")
+            logger.error("[AGENT %s] Error loading model: %s", self.agent_id, e)
+            logger.warning("[AGENT %s] Falling back to echo mode", self.agent_id)
             self.model = None
     
+    @staticmethod
+    def _load_model(model_name: str, compile_model: bool = False) -> Tuple[Any, Any, bool, _GenBatcher]:
+        """
+        Load and optimize a model for CPU generation.
+        
+        Args:
+            model_name: Name of the HuggingFace model to load
+            compile_model: Whether to compile the forward pass
+            
+        Returns:
+            Tuple of (tokenizer, model, use_bf16, batcher)
+        """
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            pad_token_id=tokenizer.eos_token_id
+        )
+        model.eval()
+        
+        # Hosts with native BF16 run the weights under BF16 autocast;
+        # everywhere else the weight GEMMs are quantized to INT8.
+        use_bf16 = _cpu_supports_bf16()
+        if not use_bf16:
+            model = _quantize_int8(model)
+        if compile_model:
+            model = _compile_forward(model, use_bf16)
+        return tokenizer, model, use_bf16, _GenBatcher(model, tokenizer, use_bf16)
+    
     async def _handle_message(self, sender: str, message: Dict[str, Any]) -> None:
         """
         Handle an incoming message.
@@ -87,11 +460,11 @@ class Agent:
             sender: ID of the sending agent
             message: The message content
         """
-        logger.info(f"[AGENT {self.agent_id}] Received from {sender}: {message.get('content', '')}")
+        logger.debug("[AGENT %s] Received from %s: %s", self.agent_id, sender, message.get('content', ''))
         
         # Update conversation history
         if sender not in self.conversation_history:
-            self.conversation_history[sender] = []
+            self.conversation_history[sender] = deque(maxlen=HISTORY_SIZE)
         self.conversation_history[sender].append(("them", message.get('content', '')))
         
         # If we have a custom message handler, use it
@@ -103,6 +476,36 @@ class Agent:
             if response:
                 await self.send_message(sender, response)
     
+    async def _get_prefix_cache(self, sender: str) -> Tuple[Any, Any]:
+        """
+        Get the token IDs and KV cache for the prompt prefix used with a sender.
+        
+        The prefix only depends on the sender, so it is encoded through the
+        model once and reused until it falls out of the LRU cache.
+        
+        Args:
+            sender: ID of the sender
+            
+        Returns:
+            Tuple of (prefix_ids, past_key_values)
+        """
+        entry = self._prefix_kv_cache.get(sender)
+        if entry is not None:
+            self._prefix_kv_cache.move_to_end(sender)
+            return entry
+        
+        sender_ids = self.tokenizer(
+            f" {sender} about the weather in Toronto.\n\n", return_tensors='pt'
+        ).input_ids
+        prefix_ids = torch.cat([self._static_prefix_ids, sender_ids], dim=-1)
+        past_key_values = await self._batcher.encode_prefix(prefix_ids)
+        
+        entry = (prefix_ids, past_key_values)
+        self._prefix_kv_cache[sender] = entry
+        if len(self._prefix_kv_cache) > PREFIX_CACHE_SIZE:
+            self._prefix_kv_cache.popitem(last=False)
+        return entry
+    
     async def _generate_response(self, sender: str, message: str) -> str:
         """
         Generate a response to a message about Toronto's weather.
@@ -119,32 +522,21 @@ class Agent:
             return f"I can't access the weather model right now, but I hope the weather in Toronto is nice today!"
         
         try:
-            # Create a more focused prompt about Toronto's weather
-            prompt = (
-                f"Conversation about Toronto's weather. "
-                f"{self.agent_id} is talking to {sender} about the weather in Toronto.\n\n"
-                f"{sender}: {message}\n"
-                f"{self.agent_id}:"
-            )
-            
-            # Generate response using the model with more focused parameters
-            response = self.generator(
-                prompt,
-                max_length=150,
-                num_return_sequences=1,
-                temperature=0.8,  # Slightly higher for more creative responses
-                top_k=40,
-                top_p=0.9,
-                do_sample=True,
-                pad_token_id=50256  # Ensure we have an end token
-            )
+            # Create a more focused prompt about Toronto's weather; only the
+            # part after the cached per-sender prefix has to be encoded
+            prefix_ids, prefix_kv = await self._get_prefix_cache(sender)
+            turn_ids = self.tokenizer(
+                f"{sender}: {message}\n{self.agent_id}:", return_tensors='pt'
+            ).input_ids
+            input_ids = torch.cat([prefix_ids, turn_ids], dim=-1)
             
-            # Extract and clean the response
-            full_text = response[0]['generated_text']
-            response_text = full_text[len(prompt):].strip()
+            # Generate response using the model, batched with any other agents
+            # generating on the same model at the same time
+            new_ids = await self._batcher.generate(input_ids, prefix_kv)
             
-            # Clean up the response
-            response_text = response_text.split('\n')[0].strip()
+            # Decode only the newly generated tokens and keep the first line
+            generated = self.tokenizer.decode(new_ids, skip_special_tokens=True)
+            response_text = _FIRST_LINE.match(generated).group(1).strip()
             
             # Ensure we have a valid response
             if not response_text or len(response_text) < 2:
@@ -152,26 +544,27 @@ class Agent:
                 
             # Add to conversation history
             if sender not in self.conversation_history:
-                self.conversation_history[sender] = []
+                self.conversation_history[sender] = deque(maxlen=HISTORY_SIZE)
             self.conversation_history[sender].append(("me", response_text))
-            
-            # Ensure the response isn't too long
-            if len(response_text) > 200:
-                response_text = response_text[:197] + "..."
                 
             return response_text
             
         except Exception as e:
-            print(f"[AGENT {self.agent_id}] Error generating response: {e}")
+            logger.error("[AGENT %s] Error generating response: %s", self.agent_id, e)
             # Fallback responses about Toronto's weather
-            fallbacks = [
-                "I heard Toronto is experiencing seasonal temperatures today.",
-                "The weather in Toronto is always changing, isn't it?",
-                "I don't have the latest forecast, but I hope Toronto's weather is pleasant!",
-                "It's a beautiful day in Toronto, don't you think?"
-            ]
-            import random
-            return random.choice(fallbacks)
+            return random.choice(_WEATHER_FALLBACKS)
+    
+    @classmethod
+    async def close_models(cls) -> None:
+        """
+        Stop the generation workers of all shared models.
+        
+        Call before the event loop shuts down, once no agent is generating.
+        """
+        with cls._MODEL_CACHE_LOCK:
+            batchers = [batcher for _, _, _, batcher in cls._MODEL_CACHE.values()]
+        for batcher in batchers:
+            await batcher.close()
     
     async def send_message(self, receiver: str, content: str) -> None:
         """
@@ -181,7 +574,7 @@ class Agent:
             receiver: ID of the receiving agent
             content: The message content
         """
-        logger.info(f"[AGENT {self.agent_id}] Sending to {receiver}: {content}")
+        logger.debug("[AGENT %s] Sending to %s: %s", self.agent_id, receiver, content)
         
         message = {
             "content": content,
@@ -191,7 +584,7 @@ class Agent:
         try:
             await self.communicator.send_message(receiver, message)
         except Exception as e:
-            logger.error(f"[AGENT {self.agent_id}] Error sending message: {e}")
+            logger.error("[AGENT %s] Error sending message: %s", self.agent_id, e)
     
     async def start_conversation(self, receiver: str, content: str) -> None:
         """
@@ -201,7 +594,7 @@ class Agent:
             receiver: ID of the agent to start a conversation with
             content: The initial message content
         """
-        logger.info(f"[AGENT {self.agent_id}] Starting conversation with {receiver}")
+        logger.info("[AGENT %s] Starting conversation with %s", self.agent_id, receiver)
         await self.send_message(receiver, content)
     
     async def close(self) -> None:
@@ -216,11 +609,3 @@ class Agent:
             handler: Function that takes (sender_id, message) and handles the message
         """
         self.message_handler = handler
-    
-    async def close(self) -> None:
-        """Clean up resources and unregister from the network."""
-        await self.mesh.unregister_agent(self.agent_id)
-        if hasattr(self, 'model'):
-            del self.model
-        if hasattr(self, 'tokenizer'):
-            del self.tokenizer
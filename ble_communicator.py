@@ -5,22 +5,25 @@ This module provides a simple BLE communication layer for agent communication
 between two separate machines using the Bleak library.
 """
 import asyncio
-import json
 import logging
 import uuid
-from typing import Dict, Callable, Optional, Any
+from typing import Dict, Callable, Optional, Any, List
 
 from bleak import BleakClient, BleakServer, BleakScanner
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 
+from ble_wire import (
+    DEFAULT_CHUNK_SIZE, MESSAGE_CHAR_UUID, SERVICE_UUID,
+    encode_frame, negotiate_mtu, reassemble, write_payload
+)
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# BLE Service and Characteristic UUIDs
-SERVICE_UUID = "0000ffe0-0000-1000-8000-00805f9b34fb"
-MESSAGE_CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+# Outbound messages that may wait per peer before send_message blocks
+SEND_QUEUE_SIZE = 1024
 
 class BLECommunicator:
     """
@@ -39,8 +42,13 @@ class BLECommunicator:
         self.client = None
         self.server = None
         self.connected = False
-        self.message_queue = asyncio.Queue()
+        self.message_queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
         self.target_device = None
+        self.mtu = DEFAULT_CHUNK_SIZE
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: List[asyncio.Task] = []  # Background tasks started by start()
+        # Partial incoming messages; one peer per receive path
+        self._rx_buffers: Dict[str, bytearray] = {}
         
     async def start(self, message_callback: Callable[[str, dict], None]) -> None:
         """
@@ -54,14 +62,22 @@ class BLECommunicator:
         # Start the BLE server
         await self._start_server()
         
-        # Start scanning for other devices
-        asyncio.create_task(self._scan_for_devices())
-        
-        # Start processing outgoing messages
-        asyncio.create_task(self._process_message_queue())
+        # Start scanning for other devices and processing outgoing
+        # messages; the handles are kept so stop() can cancel them
+        self._tasks = [
+            asyncio.create_task(self._scan_for_devices()),
+            asyncio.create_task(self._process_message_queue()),
+        ]
     
     async def stop(self) -> None:
         """Stop the BLE communicator and clean up resources."""
+        for task in self._tasks:
+            task.cancel()
+        for result in await asyncio.gather(*self._tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Background task failed: %s", result)
+        self._tasks = []
+        
         if self.client and self.client.is_connected:
             await self.client.disconnect()
         if self.server:
@@ -75,28 +91,35 @@ class BLECommunicator:
             target_id: ID of the target agent
             message: Message data to send (must be JSON serializable)
         """
-        message_data = {
-            "sender": self.agent_id,
-            "recipient": target_id,
-            "timestamp": asyncio.get_event_loop().time(),
-            "data": message
-        }
-        await self.message_queue.put(message_data)
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        
+        # Positional (sender, recipient, timestamp, data) envelope, so the
+        # key names are not repeated in every payload on the air
+        message_data = (
+            self.agent_id,
+            target_id,
+            self._loop.time(),
+            message
+        )
+        # Encoded once here; the queue carries (target, frame)
+        frame = encode_frame(message_data)
+        await self.message_queue.put((target_id, frame))
     
     async def _process_message_queue(self) -> None:
         """Process outgoing messages from the queue."""
         while True:
-            message = await self.message_queue.get()
+            target_id, frame = await self.message_queue.get()
             
             if not self.connected or not self.client or not self.client.is_connected:
                 logger.warning("Not connected to any device. Cannot send message.")
                 continue
                 
             try:
-                await self._send_ble_message(self.client, message)
-                logger.info(f"Message sent to {message.get('recipient')}")
+                await self._send_ble_message(self.client, frame)
+                logger.debug("Message sent to %s", target_id)
             except Exception as e:
-                logger.error(f"Failed to send message: {e}")
+                logger.error("Failed to send message: %s", e)
                 self.connected = False
     
     async def _start_server(self) -> None:
@@ -106,18 +129,18 @@ class BLECommunicator:
         def notification_handler(sender, data: bytearray):
             """Handle incoming BLE notifications."""
             try:
-                message = json.loads(data.decode('utf-8'))
-                if self.callback:
-                    self.callback(message.get('sender'), message.get('data', {}))
+                for sender_id, _, _, payload in reassemble(self._rx_buffers, 'server', data):
+                    if self.callback:
+                        self.callback(sender_id, payload)
             except Exception as e:
-                logger.error(f"Error handling notification: {e}")
+                logger.error("Error handling notification: %s", e)
         
         # Add our service and characteristic
         await self.server.add_service(
             SERVICE_UUID,
             [{
                 "uuid": MESSAGE_CHAR_UUID,
-                "properties": ["read", "write", "notify"],
+                "properties": ["read", "write", "write-without-response", "notify"],
                 "value": None,
                 "descriptors": [
                     "00002902-0000-1000-8000-00805f9b34fb",  # Client Characteristic Configuration
@@ -130,7 +153,7 @@ class BLECommunicator:
         
         # Start the server
         await self.server.start()
-        logger.info(f"BLE server started as '{self.agent_id}'")
+        logger.info("BLE server started as '%s'", self.agent_id)
     
     async def _scan_for_devices(self) -> None:
         """Scan for other BLE devices."""
@@ -151,7 +174,7 @@ class BLECommunicator:
     def _detection_callback(self, device: BLEDevice, advertisement_data: AdvertisementData) -> None:
         """Handle discovered BLE devices."""
         if device.name and device.name != self.agent_id and not self.connected:
-            logger.info(f"Found device: {device.name} ({device.address})")
+            logger.info("Found device: %s (%s)", device.name, device.address)
             self.target_device = device
             asyncio.create_task(self._connect_to_device())
     
@@ -163,49 +186,44 @@ class BLECommunicator:
         if self.client and self.client.is_connected:
             return
             
-        logger.info(f"Attempting to connect to {self.target_device.name}...")
+        logger.info("Attempting to connect to %s...", self.target_device.name)
         self.client = BleakClient(self.target_device.address)
         
         try:
             await self.client.connect()
+            self.mtu = await negotiate_mtu(self.client)
             self.connected = True
-            logger.info(f"Connected to {self.target_device.name}")
+            logger.info("Connected to %s", self.target_device.name)
             
             # Start notifications
             await self.client.start_notify(MESSAGE_CHAR_UUID, self._notification_handler)
             
         except Exception as e:
-            logger.error(f"Failed to connect to {self.target_device.name}: {e}")
+            logger.error("Failed to connect to %s: %s", self.target_device.name, e)
             self.connected = False
             self.client = None
+            self.mtu = DEFAULT_CHUNK_SIZE
+            self._rx_buffers.pop('client', None)
     
-    async def _send_ble_message(self, client: BleakClient, message: dict) -> None:
+    async def _send_ble_message(self, client: BleakClient, frame: bytes) -> None:
         """
-        Send a message over BLE.
+        Send an encoded frame over BLE.
         
         Args:
             client: Connected BLE client
-            message: Message to send (will be JSON serialized)
+            frame: Length-prefixed message from encode_frame
         """
         try:
-            message_str = json.dumps(message)
-            message_bytes = message_str.encode('utf-8')
-            
-            # Send the message in chunks if needed
-            max_chunk_size = 20  # Standard BLE MTU is 20 bytes
-            for i in range(0, len(message_bytes), max_chunk_size):
-                chunk = message_bytes[i:i + max_chunk_size]
-                await client.write_gatt_char(MESSAGE_CHAR_UUID, chunk, response=True)
-                
+            await write_payload(client, frame, self.mtu)
         except Exception as e:
-            logger.error(f"Error sending message: {e}")
+            logger.error("Error sending message: %s", e)
             raise
     
     def _notification_handler(self, sender, data: bytearray) -> None:
         """Handle incoming BLE notifications."""
         try:
-            message = json.loads(data.decode('utf-8'))
-            if self.callback:
-                self.callback(message.get('sender'), message.get('data', {}))
+            for sender_id, _, _, payload in reassemble(self._rx_buffers, 'client', data):
+                if self.callback:
+                    self.callback(sender_id, payload)
         except Exception as e:
-            logger.error(f"Error handling notification: {e}")
+            logger.error("Error handling notification: %s", e)
@@ -5,28 +5,99 @@ This module provides a BLE-based mesh network for agent communication.
 It uses the Bleak library for cross-platform BLE support.
 """
 import asyncio
-import json
+import functools
 import uuid
 import platform
 import logging
-from typing import Dict, Callable, Any, Optional, List, Tuple, Set
+import time
+from typing import Dict, Callable, Any, Awaitable, Optional, List, Tuple, Set
 
 from bleak import BleakScanner, BleakClient, BleakGATTCharacteristic, BleakServer
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 
+from ble_wire import (
+    DEFAULT_CHUNK_SIZE, MESSAGE_CHAR_UUID, NAME_PREFIX, NAME_PREFIX_LEN, SERVICE_UUID,
+    encode_frame, negotiate_mtu, reassemble, spawn_callback, write_payload
+)
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# BLE Service and Characteristic UUIDs
-SERVICE_UUID = "0000ffe0-0000-1000-8000-00805f9b34fb"
-MESSAGE_CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+# Repeat advertisements from the same address within this many seconds are ignored
+DETECTION_TTL = 1.0
+
+# Outbound messages that may wait per peer before send_message blocks
+SEND_QUEUE_SIZE = 1024
+
+# Most queued messages sent to a peer as one payload
+MAX_SEND_BATCH = 32
+
+# Tries at delivering a batch before it is dropped, and the pause between them
+SEND_ATTEMPTS = 3
+SEND_RETRY_DELAY = 1.0
 
 # Global BLE server instance for this process
 _ble_server = None
 _ble_server_clients = set()
 
+# Global BLE scanner shared by every mesh in this process; each
+# advertisement it sees is handed to all subscribed meshes. The task that
+# owns it runs for as long as any mesh is subscribed.
+_ble_scanner_task: Optional[asyncio.Task] = None
+_ble_scanner_subscribers = set()
+
+
+def _dispatch_detection(device: BLEDevice, advertisement_data: AdvertisementData) -> None:
+    """Pass a discovered device to every mesh using the shared scanner."""
+    for mesh in list(_ble_scanner_subscribers):
+        mesh._detection_callback(device, advertisement_data)
+
+
+async def _run_shared_scanner() -> None:
+    """Start the shared scanner, retrying until it is up, and stop it once cancelled."""
+    scanner = BleakScanner(
+        detection_callback=_dispatch_detection,
+        service_uuids=[SERVICE_UUID],
+        scanning_mode="active"
+    )
+    logger.info("[BLE] Starting device scan...")
+    try:
+        while True:
+            try:
+                await scanner.start()
+                break
+            except Exception as e:
+                logger.error("[BLE] Error in scanner: %s", e)
+                await asyncio.sleep(1)  # Wait before retrying
+        
+        # Scanning continues in the background until the last mesh leaves
+        await asyncio.Event().wait()
+    finally:
+        try:
+            await scanner.stop()
+        except Exception as e:
+            logger.error("[BLE] Error stopping scanner: %s", e)
+
+
+def _subscribe_scanner(mesh: 'BLEMesh') -> None:
+    """Hand advertisements to a mesh, starting the shared scanner if needed."""
+    global _ble_scanner_task
+    _ble_scanner_subscribers.add(mesh)
+    if _ble_scanner_task is None or _ble_scanner_task.done():
+        _ble_scanner_task = asyncio.create_task(_run_shared_scanner())
+
+
+async def _unsubscribe_scanner(mesh: 'BLEMesh') -> None:
+    """Stop handing advertisements to a mesh; the last one out stops the scanner."""
+    global _ble_scanner_task
+    _ble_scanner_subscribers.discard(mesh)
+    if not _ble_scanner_subscribers and _ble_scanner_task is not None:
+        task, _ble_scanner_task = _ble_scanner_task, None
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
 class BLEMesh:
     """
     A BLE-based mesh network implementation for agent communication.
@@ -43,14 +114,28 @@ class BLEMesh:
         
         self.agent_id = agent_id
         self.callbacks: Dict[str, Callable[[str, dict], None]] = {}
+        self._callback_is_async: Dict[str, bool] = {}
+        self._callback_tasks: Set[asyncio.Task] = set()  # Coroutine callbacks still running
         self.connected_devices: Dict[str, BleakClient] = {}
+        self._clients: Dict[str, BleakClient] = {}  # Client per peer address, reused on reconnect
+        self._connect_locks: Dict[str, asyncio.Lock] = {}  # One connect attempt per peer at a time
+        self._mtu: Dict[str, int] = {}  # Usable write payload size per peer address
+        self._addr_to_peer_id: Dict[str, str] = {}
+        self._known_addresses: Dict[str, str] = {}  # Last advertised address per peer
+        self._recent_detections: Dict[str, float] = {}  # Last time each address was handled
+        self._rx_buffers: Dict[str, bytearray] = {}  # Partial messages per peer address
         self.is_advertising = False
-        self.message_queue = asyncio.Queue()
+        self._stop_event = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []  # Background tasks started by start()
+        self._peer_queues: Dict[str, asyncio.Queue] = {}  # Outbound messages per peer
+        self._peer_senders: Dict[str, asyncio.Task] = {}
+        self._pending_targets: Set[str] = set()  # Peers with messages not yet delivered
         self.scanning = False
         self._local_agents: Dict[str, Callable[[str, dict], None]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
         
         # Generate a unique local name for BLE advertisement
-        self.local_name = f"AgentMesh-{agent_id}"
+        self.local_name = NAME_PREFIX + agent_id
         
         # Initialize the shared BLE server if it doesn't exist
         if _ble_server is None:
@@ -64,10 +149,12 @@ class BLEMesh:
         if hasattr(self, 'ble_server'):
             await self._register_local_agent()
         
-        # Start advertising and scanning in the background
-        asyncio.create_task(self._advertise())
-        asyncio.create_task(self._scan_for_peers())
-        asyncio.create_task(self._process_message_queue())
+        # Start advertising and scanning in the background; the handles
+        # are kept so stop() can cancel them and collect their errors
+        self._tasks = [
+            asyncio.create_task(self._advertise()),
+            asyncio.create_task(self._scan_for_peers()),
+        ]
     
     async def _register_local_agent(self):
         """Register this agent with other local agents."""
@@ -77,24 +164,63 @@ class BLEMesh:
                 self._local_agents[client.agent_id] = client._handle_incoming_message
                 client._local_agents[self.agent_id] = self._handle_incoming_message
     
-    async def _handle_incoming_message(self, sender_id: str, message: dict) -> None:
-        """Handle incoming messages from local agents."""
+    def _handle_incoming_message(self, sender_id: str, message: dict) -> Optional[Awaitable[None]]:
+        """
+        Handle incoming messages from local agents.
+        
+        Plain callbacks are run right away. For coroutine callbacks the
+        coroutine is returned for the caller to await.
+        
+        Returns:
+            Optional[Awaitable[None]]: Pending callback, or None if it already ran
+        """
         if 'type' in message and message['type'] in self.callbacks:
+            callback = self.callbacks[message['type']]
+            if self._callback_is_async[message['type']]:
+                return self._run_local_callback(callback, sender_id, message['data'])
             try:
-                await self.callbacks[message['type']](sender_id, message['data'])
+                callback(sender_id, message['data'])
             except Exception as e:
-                print(f"[BLE] Error in local message handler: {e}")
+                logger.error("[BLE] Error in local message handler: %s", e)
+        return None
+    
+    async def _run_local_callback(self, callback: Callable, sender_id: str, data: Any) -> None:
+        """Await a coroutine callback for a local message."""
+        try:
+            await callback(sender_id, data)
+        except Exception as e:
+            logger.error("[BLE] Error in local message handler: %s", e)
     
     async def stop(self) -> None:
         """Stop the BLE mesh network."""
         self.is_advertising = False
-        self.scanning = False
+        self._stop_event.set()
+        if self.scanning:
+            self.scanning = False
+            await _unsubscribe_scanner(self)
+        
+        # Stop the background and per-peer sender tasks
+        tasks = self._tasks + list(self._peer_senders.values())
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("[BLE] Background task failed: %s", result)
+        self._tasks = []
+        self._peer_senders.clear()
+        self._peer_queues.clear()
+        self._pending_targets.clear()
         
         # Disconnect all connected devices
         for device_id, client in list(self.connected_devices.items()):
             if client.is_connected:
                 await client.disconnect()
             del self.connected_devices[device_id]
+            self._mtu.pop(client.address, None)
+            self._addr_to_peer_id.pop(client.address, None)
+            self._rx_buffers.pop(client.address, None)
+        self._clients.clear()
+        self._connect_locks.clear()
     
     def register_callback(self, message_type: str, callback: Callable[[str, dict], None]) -> None:
         """
@@ -105,6 +231,7 @@ class BLEMesh:
             callback: Function to call when message is received
         """
         self.callbacks[message_type] = callback
+        self._callback_is_async[message_type] = asyncio.iscoroutinefunction(callback)
     
     async def send_message(self, target_id: str, message: dict) -> None:
         """
@@ -118,49 +245,93 @@ class BLEMesh:
         if target_id in self._local_agents:
             # Route locally
             try:
-                await self._local_agents[target_id](self.agent_id, message)
+                # Direct call; only coroutine callbacks need an await
+                pending = self._local_agents[target_id](self.agent_id, message)
+                if pending is not None:
+                    await pending
                 return
             except Exception as e:
-                print(f"[BLE] Error sending to local agent {target_id}: {e}")
+                logger.error("[BLE] Error sending to local agent %s: %s", target_id, e)
+        
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
         
-        # For remote agents, use BLE
-        message_with_meta = {
-            "sender": self.agent_id,
-            "recipient": target_id,
-            "timestamp": asyncio.get_event_loop().time(),
-            "data": message
-        }
+        # For remote agents, use BLE. The envelope is positional
+        # (sender, recipient, timestamp, data) to keep key names off the air.
+        message_with_meta = (
+            self.agent_id,
+            target_id,
+            self._loop.time(),
+            message
+        )
         
-        # Add to message queue for processing
-        await self.message_queue.put((target_id, message_with_meta))
+        # Encoded once here; the sender only slices it into writes
+        frame = encode_frame(message_with_meta)
+        
+        # Queue on the target's own sender so a slow peer doesn't hold up the others
+        queue = self._peer_queues.get(target_id)
+        if queue is None:
+            queue = self._peer_queues[target_id] = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        sender = self._peer_senders.get(target_id)
+        if sender is None or sender.done():
+            # First message to this peer, or its sender has died; start a
+            # new one on the same queue so nothing already queued is lost
+            self._peer_senders[target_id] = asyncio.create_task(self._peer_sender(target_id))
+        self._pending_targets.add(target_id)
+        try:
+            queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # The peer can't keep up; wait for room, unless the mesh stops first
+            put = asyncio.ensure_future(queue.put(frame))
+            stopped = asyncio.ensure_future(self._stop_event.wait())
+            await asyncio.wait({put, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            put.cancel()
+            stopped.cancel()
+            if not put.done() or put.cancelled():
+                logger.error("[BLE] Dropped message to %s: mesh stopped", target_id)
     
-    async def _process_message_queue(self) -> None:
-        """Process messages from the send queue."""
+    async def _peer_sender(self, target_id: str) -> None:
+        """
+        Send queued messages to one peer, in order.
+        
+        Args:
+            target_id: ID of the peer this task sends to
+        """
+        queue = self._peer_queues[target_id]
         while True:
-            target_id, message = await self.message_queue.get()
-            
-            # Check if we're already connected to the target
-            client = self.connected_devices.get(target_id)
+            # Take up to MAX_SEND_BATCH queued messages and send them as one
+            # payload; frames are length-prefixed, so the receiver splits
+            # them apart again
+            frames = [await queue.get()]
+            while len(frames) < MAX_SEND_BATCH:
+                try:
+                    frames.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            payload = b''.join(frames)
             
-            if client and client.is_connected:
+            # Connect if needed and send; a failed batch is retried (after
+            # reconnecting) rather than dropped straight away
+            for attempt in range(SEND_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(SEND_RETRY_DELAY)
                 try:
-                    # Send the message
-                    await self._send_ble_message(client, message)
-                    print(f"[BLE] Sent message to {target_id}")
+                    # Discovery inside the connect can raise too; that counts
+                    # as a failed attempt rather than ending this task
+                    if not await self._connect_to_peer(target_id):
+                        logger.warning("[BLE] Could not connect to %s", target_id)
+                        continue
+                    await self._send_ble_message(self.connected_devices[target_id], payload)
+                    logger.debug("[BLE] Sent %d message(s) to %s", len(frames), target_id)
+                    break
                 except Exception as e:
-                    print(f"[BLE] Error sending to {target_id}: {e}")
-                    # Reconnect and retry
-                    await self._connect_to_peer(target_id)
+                    logger.error("[BLE] Error sending to %s: %s", target_id, e)
             else:
-                # Try to connect and send
-                if await self._connect_to_peer(target_id):
-                    try:
-                        await self._send_ble_message(self.connected_devices[target_id], message)
-                        print(f"[BLE] Sent message to {target_id}")
-                    except Exception as e:
-                        print(f"[BLE] Failed to send to {target_id}: {e}")
-                else:
-                    print(f"[BLE] Could not connect to {target_id}")
+                logger.error("[BLE] Dropping %d message(s) to %s", len(frames), target_id)
+            
+            # Sent or dropped, nothing is waiting for this peer once the queue is empty
+            if queue.empty():
+                self._pending_targets.discard(target_id)
     
     def _create_ble_server(self) -> 'BLEMesh':
         """Create a shared BLE server for all agents on this device."""
@@ -172,7 +343,7 @@ class BLEMesh:
             [
                 {
                     "uuid": MESSAGE_CHAR_UUID,
-                    "properties": ["read", "write", "notify"],
+                    "properties": ["read", "write", "write-without-response", "notify"],
                     "value": None,
                 }
             ]
@@ -180,75 +351,96 @@ class BLEMesh:
         
         # Start the server
         asyncio.create_task(server.start())
-        print(f"[BLE] Shared BLE server started")
+        logger.info("[BLE] Shared BLE server started")
         return server
     
     async def _advertise(self) -> None:
         """Advertise this device's presence on the BLE network."""
         self.is_advertising = True
-        print(f"[BLE] Agent {self.agent_id} is active")
+        logger.info("[BLE] Agent %s is active", self.agent_id)
         
-        # Keep the agent running
-        while self.is_advertising:
-            await asyncio.sleep(1)
+        # Keep the agent running until stop()
+        await self._stop_event.wait()
+        self.is_advertising = False
     
     async def _scan_for_peers(self) -> None:
         """Scan for other BLE mesh devices."""
+        # One scanner, owned by a module-level task, serves every mesh in
+        # the process; this mesh just subscribes to its advertisements
         self.scanning = True
-        print("[BLE] Starting device scan...")
-        
-        while self.scanning:
-            try:
-                # Windows-specific BLE scan settings
-                scanner = BleakScanner(
-                    detection_callback=self._detection_callback,
-                    service_uuids=[SERVICE_UUID],
-                    scanning_mode="active"
-                )
-                
-                async with scanner:
-                    print("[BLE] Scanning for peers...")
-                    await asyncio.sleep(5.0)  # Scan for 5 seconds
-                    
-            except Exception as e:
-                print(f"[BLE] Error in scanner: {e}")
-                await asyncio.sleep(1)  # Wait before retrying
+        _subscribe_scanner(self)
     
     def _detection_callback(self, device, advertisement_data):
         """Handle discovered BLE devices."""
         try:
             if not device or not device.name:
                 return
+            
+            # Active scanning reports the same device many times a second;
+            # handle each address at most once per DETECTION_TTL
+            now = time.monotonic()
+            last = self._recent_detections.get(device.address)
+            if last is not None and now - last < DETECTION_TTL:
+                return
+            self._recent_detections[device.address] = now
+            if len(self._recent_detections) > 256:
+                self._recent_detections = {
+                    address: seen for address, seen in self._recent_detections.items()
+                    if now - seen < DETECTION_TTL
+                }
                 
             # Skip if this is our own advertisement
             if device.name == self.local_name:
                 return
                 
-            if device.name.startswith("AgentMesh-"):
-                peer_id = device.name.split("-", 1)[1]
+            name = device.name
+            if name.startswith(NAME_PREFIX):
+                peer_id = name[NAME_PREFIX_LEN:]
                 
                 # Skip if we're already connected or this is us
-                if peer_id == self.agent_id or peer_id in self.connected_devices:
+                if peer_id == self.agent_id:
+                    return
+                self._known_addresses[peer_id] = device.address
+                if peer_id in self.connected_devices:
                     return
                 
                 # Skip if this is a local agent
                 if peer_id in self._local_agents:
                     return
                     
-                print(f"[BLE] Found remote peer: {peer_id} at {device.address}")
+                logger.info("[BLE] Found remote peer: %s at %s", peer_id, device.address)
                 
                 # Only connect if we have an active message for this peer
                 # This prevents unnecessary connections
-                if any(target == peer_id for target, _ in self.message_queue._queue):
+                if peer_id in self._pending_targets:
                     asyncio.create_task(self._connect_to_peer(peer_id, device.address))
                     
         except Exception as e:
-            print(f"[BLE] Error in detection callback: {e}")
+            logger.error("[BLE] Error in detection callback: %s", e)
     
     async def _connect_to_peer(self, peer_id: str, address: str = None) -> bool:
         """
         Connect to a peer device.
         
+        Args:
+            peer_id: ID of the peer to connect to
+            address: BLE address of the peer (optional, will scan if not provided)
+            
+        Returns:
+            bool: True if connection was successful, False otherwise
+        """
+        # The detection callback and the peer's sender can both ask for a
+        # connection; the second caller waits and reuses the first's result
+        lock = self._connect_locks.get(peer_id)
+        if lock is None:
+            lock = self._connect_locks[peer_id] = asyncio.Lock()
+        async with lock:
+            return await self._connect(peer_id, address)
+    
+    async def _connect(self, peer_id: str, address: Optional[str]) -> bool:
+        """
+        Connect to a peer device; callers hold the peer's connect lock.
+        
         Args:
             peer_id: ID of the peer to connect to
             address: BLE address of the peer (optional, will scan if not provided)
@@ -259,77 +451,90 @@ class BLEMesh:
         if peer_id in self.connected_devices and self.connected_devices[peer_id].is_connected:
             return True
             
+        if not address:
+            # Use the address the scanner last saw the peer at, if any
+            address = self._known_addresses.get(peer_id)
+        
         if not address:
             # Try to find the device by name if address not provided
             devices = await BleakScanner.discover(timeout=5.0)
             for device in devices:
-                if device.name == f"AgentMesh-{peer_id}":
+                if device.name == NAME_PREFIX + peer_id:
                     address = device.address
                     break
             
             if not address:
-                print(f"[BLE] Could not find device for {peer_id}")
+                logger.warning("[BLE] Could not find device for %s", peer_id)
                 return False
         
         try:
-            print(f"[BLE] Connecting to {peer_id} at {address}...")
-            client = BleakClient(address)
+            logger.info("[BLE] Connecting to %s at %s...", peer_id, address)
+            client = self._clients.get(address)
+            if client is None:
+                client = BleakClient(address)
+                self._clients[address] = client
             await client.connect()
+            self._mtu[client.address] = await negotiate_mtu(client)
             
             # Discover services
-            await client.start_notify(MESSAGE_CHAR_UUID, self._notification_handler)
+            await client.start_notify(
+                MESSAGE_CHAR_UUID,
+                functools.partial(self._notification_handler, client.address)
+            )
             
             # Store the connection
             self.connected_devices[peer_id] = client
-            print(f"[BLE] Connected to {peer_id}")
+            self._addr_to_peer_id[client.address] = peer_id
+            logger.info("[BLE] Connected to %s", peer_id)
             return True
             
         except Exception as e:
-            print(f"[BLE] Failed to connect to {peer_id}: {e}")
+            logger.error("[BLE] Failed to connect to %s: %s", peer_id, e)
             if peer_id in self.connected_devices:
                 del self.connected_devices[peer_id]
+            # The peer may have moved; rediscover it next time
+            self._known_addresses.pop(peer_id, None)
+            self._clients.pop(address, None)
+            self._mtu.pop(address, None)
+            self._addr_to_peer_id.pop(address, None)
+            self._rx_buffers.pop(address, None)
             return False
     
-    async def _send_ble_message(self, client: BleakClient, message: dict) -> None:
+    async def _send_ble_message(self, client: BleakClient, payload: bytes) -> None:
         """
-        Send a message over BLE.
+        Send encoded frames over BLE.
         
         Args:
             client: Connected BLE client
-            message: Message to send (will be JSON serialized)
+            payload: One or more frames from encode_frame, back to back
         """
         try:
-            # Convert message to bytes
-            message_str = json.dumps(message)
-            message_bytes = message_str.encode('utf-8')
-            
-            # Send the message in chunks if needed
-            max_chunk_size = 20  # Standard BLE MTU is 20 bytes
-            for i in range(0, len(message_bytes), max_chunk_size):
-                chunk = message_bytes[i:i + max_chunk_size]
-                await client.write_gatt_char(MESSAGE_CHAR_UUID, chunk, response=True)
-                
+            await write_payload(client, payload, self._mtu.get(client.address, DEFAULT_CHUNK_SIZE))
         except Exception as e:
-            print(f"[BLE] Error sending message: {e}")
+            logger.error("[BLE] Error sending message: %s", e)
             raise
     
-    def _notification_handler(self, sender: BleakGATTCharacteristic, data: bytearray) -> None:
-        """Handle incoming BLE notifications."""
+    def _notification_handler(self, address: str, sender: BleakGATTCharacteristic, data: bytearray) -> None:
+        """
+        Handle incoming BLE notifications.
+        
+        Args:
+            address: Address of the peer the notification came from (bound at connect)
+            sender: Characteristic that notified
+            data: Raw notification data
+        """
         try:
-            # Reassemble message chunks (simplified)
-            message_str = data.decode('utf-8')
-            message = json.loads(message_str)
-            
             # Find the sender's ID from our connected devices
-            sender_id = None
-            for peer_id, client in self.connected_devices.items():
-                if client.address == sender.service.client.address:
-                    sender_id = peer_id
-                    break
+            sender_id = self._addr_to_peer_id.get(address)
             
-            if sender_id and 'type' in message and message['type'] in self.callbacks:
-                # Call the appropriate callback
-                self.callbacks[message['type']](sender_id, message['data'])
+            # Reassemble message chunks; parse only complete messages
+            for _, _, _, message in reassemble(self._rx_buffers, address, data):
+                if sender_id and 'type' in message and message['type'] in self.callbacks:
+                    # Call the appropriate callback; coroutine callbacks
+                    # can't be awaited from here, so schedule them
+                    result = self.callbacks[message['type']](sender_id, message)
+                    if self._callback_is_async[message['type']]:
+                        spawn_callback(self._callback_tasks, result)
                 
         except Exception as e:
-            print(f"[BLE] Error handling notification: {e}")
+            logger.error("[BLE] Error handling notification: %s", e)
@@ -13,9 +13,11 @@ import sys
 import random
 import argparse
 import json
+from collections import defaultdict
 from datetime import datetime
 from typing import List, Dict, Optional
 from simple_ble_mesh import SimpleBLEMesh as BLEMesh
+from stdin_reader import StdinReader
 
 # Sample conversation topics for auto mode
 CONVERSATION_TOPICS = [
@@ -37,58 +39,67 @@ class AutoChat:
         self.mesh = mesh
         self.peers: List[str] = []
         self.is_active = False
-        self.conversation_history: Dict[str, List[Dict]] = {}
+        self.conversation_history: Dict[str, List[Dict]] = defaultdict(list)
+        self._has_peers = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
     
     async def start(self):
         """Start the auto-chat mode."""
         self.is_active = True
-        asyncio.create_task(self._auto_chat_loop())
+        self._task = asyncio.create_task(self._auto_chat_loop())
     
     async def stop(self):
         """Stop the auto-chat mode."""
         self.is_active = False
+        # The loop may be parked waiting for a peer; don't leave it behind
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
     
     def add_peer(self, peer_id: str):
         """Add a peer to the list of known peers."""
         if peer_id != self.agent_id and peer_id not in self.peers:
             self.peers.append(peer_id)
-            self.conversation_history[peer_id] = []
+            self._has_peers.set()
             print(f"[AUTO] Added peer: {peer_id}")
     
     async def _auto_chat_loop(self):
         """Main loop for automated chatting."""
         while self.is_active:
-            if self.peers:
-                # Select a random peer
-                peer = random.choice(self.peers)
-                
-                # Generate a message
-                if not self.conversation_history[peer]:
-                    # First message to this peer
-                    message = f"Hello! I'm {self.agent_id}. {random.choice(CONTEXT_PROMPTS)}"
+            # Sleep until there is someone to talk to
+            await self._has_peers.wait()
+            
+            # Select a random peer
+            peer = random.choice(self.peers)
+            
+            # Generate a message
+            if not self.conversation_history[peer]:
+                # First message to this peer
+                message = f"Hello! I'm {self.agent_id}. {random.choice(CONTEXT_PROMPTS)}"
+            else:
+                # Continue the conversation
+                last_msg = self.conversation_history[peer][-1]
+                if last_msg['sender'] == self.agent_id:
+                    # Wait for response
+                    await asyncio.sleep(random.uniform(2, 5))
+                    continue
                 else:
-                    # Continue the conversation
-                    last_msg = self.conversation_history[peer][-1]
-                    if last_msg['sender'] == self.agent_id:
-                        # Wait for response
-                        await asyncio.sleep(random.uniform(2, 5))
-                        continue
-                    else:
-                        # Respond to the last message
-                        message = self._generate_response(peer)
-                
-                # Send the message
-                await self.mesh.send_message(peer, {
-                    "type": "chat",
-                    "content": message,
-                    "timestamp": datetime.now().isoformat()
-                })
-                
-                # Add to conversation history
-                self._add_to_history(peer, self.agent_id, message)
-                
-                print(f"[AUTO] Sent to {peer}: {message}")
-                
+                    # Respond to the last message
+                    message = self._generate_response(peer)
+            
+            # Send the message
+            timestamp = datetime.now().isoformat()
+            await self.mesh.send_message(peer, {
+                "type": "chat",
+                "content": message,
+                "timestamp": timestamp
+            })
+            
+            # Add to conversation history
+            self._add_to_history(peer, self.agent_id, message, timestamp)
+            
+            print(f"[AUTO] Sent to {peer}: {message}")
+            
             # Wait before next message
             await asyncio.sleep(random.uniform(5, 10))
     
@@ -119,15 +130,13 @@ class AutoChat:
         
         return random.choice(responses)
     
-    def _add_to_history(self, peer_id: str, sender: str, message: str):
-        """Add a message to the conversation history."""
-        if peer_id not in self.conversation_history:
-            self.conversation_history[peer_id] = []
-        
+    def _add_to_history(self, peer_id: str, sender: str, message: str,
+                        timestamp: Optional[str] = None):
+        """Add a message to the conversation history (timestamped now unless given)."""
         self.conversation_history[peer_id].append({
             'sender': sender,
             'content': message,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': timestamp or datetime.now().isoformat()
         })
 
 # Sample context prompts for initial messages
@@ -152,6 +161,13 @@ class BLETestAgent:
         self.auto_chat = AutoChat(agent_id, self.mesh)
         self.running = False
         self.auto_mode = False
+        # Reading stdin blocks for as long as the user is idle, so it happens
+        # on a daemon thread that can't hold up interpreter exit
+        self._stdin = StdinReader()
+        self._input_task: Optional[asyncio.Task] = None
+        # Set by stop(); start() waits on it instead of polling self.running
+        self._stopped = asyncio.Event()
+        self._stopping = False
         
     async def start(self):
         """Start the agent and BLE mesh."""
@@ -181,28 +197,35 @@ class BLETestAgent:
         print("\nType your command and press Enter...\n")
         
         # Start the input loop
-        asyncio.create_task(self._input_loop())
+        self._input_task = asyncio.create_task(self._input_loop())
         
         # Keep the agent running
-        while self.running:
-            await asyncio.sleep(1)
+        await self._stopped.wait()
     
     async def stop(self):
-        """Stop the agent and clean up."""
+        """Stop the agent and clean up; later calls do nothing."""
+        if self._stopping:
+            return
+        self._stopping = True
         self.running = False
-        await self.mesh.stop()
+        if self._input_task is not None and self._input_task is not asyncio.current_task():
+            self._input_task.cancel()
+        try:
+            await self.auto_chat.stop()
+            await self.mesh.stop()
+        finally:
+            self._stopped.set()
     
     async def _input_loop(self):
         """Handle user input in the background."""
         while self.running:
             try:
                 # Get user input
-                user_input = await asyncio.get_event_loop().run_in_executor(
-                    None, input, f"[{self.agent_id}] > "
-                )
+                print(f"[{self.agent_id}] > ", end="", flush=True)
+                user_input = await self._stdin.readline()
                 
                 # Check for commands
-                if user_input.lower() in ('exit', 'quit', '/exit'):
+                if user_input is None or user_input.lower() in ('exit', 'quit', '/exit'):
                     print("Shutting down...")
                     await self.stop()
                     return
@@ -246,15 +269,16 @@ class BLETestAgent:
                 recipient_id, message = parts
                 
                 # Send the message
+                timestamp = datetime.now().isoformat()
                 await self.mesh.send_message(recipient_id, {
                     "type": "chat",
                     "content": message,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": timestamp
                 })
                 print(f"[SENT to {recipient_id}] {message}")
                 
                 # Add to conversation history
-                self.auto_chat._add_to_history(recipient_id, self.agent_id, message)
+                self.auto_chat._add_to_history(recipient_id, self.agent_id, message, timestamp)
                 
             except Exception as e:
                 print(f"Error: {e}")
@@ -0,0 +1,177 @@
+"""
+BLE Wire Format
+
+Message encoding, framing and GATT writes shared by the BLE mesh and
+communicator implementations.
+"""
+import asyncio
+import functools
+import json
+import logging
+import struct
+from typing import Any, Awaitable, Dict, Hashable, List, Set
+
+from bleak import BleakClient
+
+# Prefer orjson (C-accelerated, works on bytes directly) for the wire format
+try:
+    import orjson
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    def loads(data: Any) -> Any:
+        return json.loads(bytes(data))
+
+# BLE Service and Characteristic UUIDs
+SERVICE_UUID = "0000ffe0-0000-1000-8000-00805f9b34fb"
+MESSAGE_CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+
+# Advertised name prefix that marks an agent; the rest of the name is its ID
+NAME_PREFIX = "AgentMesh-"
+NAME_PREFIX_LEN = len(NAME_PREFIX)
+
+# Write payload size for the default 23-byte ATT MTU (MTU minus 3 bytes of header)
+DEFAULT_CHUNK_SIZE = 20
+
+# Every message on the air is prefixed with its length (4 bytes, big-endian)
+# so receivers can reassemble it from MTU-sized notifications
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def encode_frame(message: Any) -> bytes:
+    """
+    Serialize a message into a length-prefixed frame.
+
+    Args:
+        message: Message to send (must be JSON serializable)
+
+    Returns:
+        bytes: Length header followed by the encoded message
+    """
+    body = dumps(message)
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+async def negotiate_mtu(client: BleakClient) -> int:
+    """
+    Get the largest write payload a connected peer accepts.
+
+    WinRT and CoreBluetooth negotiate the ATT MTU while connecting;
+    BlueZ only reports it once it has been acquired explicitly.
+
+    Args:
+        client: Connected BLE client
+
+    Returns:
+        int: Usable payload size in bytes (ATT MTU minus header)
+    """
+    backend = getattr(client, '_backend', None)
+    if hasattr(backend, '_acquire_mtu'):
+        try:
+            await backend._acquire_mtu()
+        except Exception as e:
+            logger.debug("[BLE] Could not acquire MTU: %s", e)
+    return max(client.mtu_size - 3, DEFAULT_CHUNK_SIZE)
+
+
+async def write_payload(client: BleakClient, payload: bytes, mtu: int) -> None:
+    """
+    Write encoded frames to a peer's message characteristic.
+
+    A payload that fits goes out as a single write-without-response.
+    Anything larger is sent in MTU-sized chunks, sliced without copying;
+    only the last chunk waits for an acknowledgement, the earlier ones
+    are pipelined as write-without-response.
+
+    Args:
+        client: Connected BLE client
+        payload: One or more frames from encode_frame, back to back
+        mtu: Usable write payload size for this peer
+    """
+    if len(payload) <= mtu:
+        await client.write_gatt_char(MESSAGE_CHAR_UUID, payload, response=False)
+        return
+    view = memoryview(payload)
+    last = len(payload) - mtu
+    for i in range(0, len(payload), mtu):
+        await client.write_gatt_char(MESSAGE_CHAR_UUID, view[i:i + mtu], response=i >= last)
+
+
+def spawn_callback(tasks: Set[asyncio.Task], pending: Awaitable) -> asyncio.Task:
+    """
+    Run a coroutine callback as a task that is logged if it fails.
+
+    Callbacks can't be awaited from a notification handler, so they are
+    scheduled instead; the task is kept in ``tasks`` until it finishes
+    so it isn't collected mid-run.
+
+    Args:
+        tasks: Set holding the caller's running callback tasks
+        pending: Coroutine returned by the callback
+
+    Returns:
+        asyncio.Task: The scheduled task
+    """
+    task = asyncio.ensure_future(pending)
+    tasks.add(task)
+    task.add_done_callback(functools.partial(_callback_done, tasks))
+    return task
+
+
+def _callback_done(tasks: Set[asyncio.Task], task: asyncio.Task) -> None:
+    """Forget a finished callback task and log its error, if any."""
+    tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("[BLE] Message callback failed: %s", task.exception())
+
+
+def reassemble(buffers: Dict[Hashable, bytearray], key: Hashable, data: bytearray) -> List[Any]:
+    """
+    Add a notification to a receive buffer and decode any complete messages.
+
+    Complete messages are parsed straight out of the notification (or
+    the buffer) through a memoryview, so no per-message copy is made.
+
+    Args:
+        buffers: Partial messages per sender; updated in place
+        key: Identifies the sender the buffer belongs to
+        data: Raw notification data
+
+    Returns:
+        List[Any]: Messages completed by this notification
+    """
+    buf = buffers.get(key)
+    if buf:
+        buf += data
+        data = buf
+
+    messages = []
+    offset = 0
+    with memoryview(data) as view:
+        while len(view) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(view, offset)
+            if length > MAX_FRAME_SIZE:
+                # Out of sync with the sender; drop what we have
+                logger.warning("[BLE] Discarding receive buffer: bad frame length %s", length)
+                offset = len(view)
+                break
+            end = offset + FRAME_HEADER.size + length
+            if len(view) < end:
+                break
+            try:
+                messages.append(loads(view[offset + FRAME_HEADER.size:end]))
+            except ValueError as e:
+                logger.warning("[BLE] Dropping undecodable message: %s", e)
+            offset = end
+
+    # Keep any incomplete tail for the next notification
+    if data is buf:
+        del buf[:offset]
+    elif offset < len(data):
+        buffers[key] = bytearray(data[offset:])
+    return messages
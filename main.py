@@ -13,6 +13,7 @@ from typing import Optional
 
 from ble_communicator import BLECommunicator
 from agent import Agent
+from stdin_reader import StdinReader
 
 # Set up logging
 logging.basicConfig(
@@ -33,20 +34,33 @@ class BLEChatApp:
         self.ble_communicator = BLECommunicator(agent_id)
         self.agent = Agent(agent_id, self.ble_communicator)
         
-        # Register signal handlers for clean shutdown
-        signal.signal(signal.SIGINT, self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
-        
         # Set up message handler
         self.agent.set_message_handler(self._handle_message)
         
         # Track connected peers
         self.connected_peers = set()
+        
+        # Reading stdin blocks while the user is idle, so it happens on a
+        # daemon thread that can't hold up interpreter exit
+        self._stdin = StdinReader()
+        
+        # Set once shutdown() has finished; ends the command interface
+        self._stop_event = asyncio.Event()
+        # Set as soon as shutdown() starts, so it only runs once
+        self._closing = False
+        
+        # Shutdown task started from a signal; kept so it isn't collected
+        self._shutdown_task: Optional[asyncio.Task] = None
     
-    def _signal_handler(self, signum, frame):
-        """Handle shutdown signals."""
+    def _signal_handler(self) -> None:
+        """Handle shutdown signals.
+        
+        Registered with loop.add_signal_handler, so it runs inside the
+        event loop rather than in an arbitrary signal frame.
+        """
         logger.info("Shutting down...")
-        asyncio.create_task(self.shutdown())
+        if self._shutdown_task is None:
+            self._shutdown_task = asyncio.get_running_loop().create_task(self.shutdown())
     
     async def _handle_message(self, sender: str, message: dict) -> None:
         """Handle incoming messages."""
@@ -58,6 +72,16 @@ class BLEChatApp:
         """Start the BLE chat application."""
         logger.info(f"Starting BLE agent: {self.agent_id}")
         
+        # Register signal handlers for clean shutdown
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._signal_handler)
+            except NotImplementedError:
+                # Not available on Windows event loops; Ctrl+C still
+                # raises KeyboardInterrupt there
+                pass
+        
         # Start the agent
         await self.agent.communicator.start(self._handle_message)
         
@@ -73,16 +97,31 @@ class BLEChatApp:
         print("  /msg <peer_id> <message> - Send a message to a peer")
         print("")
         
+        stopped = asyncio.ensure_future(self._stop_event.wait())
+        read = None
         while True:
             try:
-                user_input = input("> ").strip()
+                # Wait for the reader thread so BLE and the agent keep running;
+                # stop waiting as soon as the app shuts down
+                print("> ", end="", flush=True)
+                read = asyncio.ensure_future(self._stdin.readline())
+                await asyncio.wait({read, stopped}, return_when=asyncio.FIRST_COMPLETED)
+                if stopped.done():
+                    read.cancel()
+                    return
+                line = read.result()
+                if line is None:
+                    # End of input
+                    await self.shutdown()
+                    break
+                user_input = line.strip()
                 
                 if not user_input:
                     continue
                     
                 if user_input.lower() == '/exit':
                     await self.shutdown()
-                    return
+                    break
                     
                 elif user_input.lower() == '/help':
                     print("\nAvailable commands:")
@@ -119,13 +158,24 @@ class BLEChatApp:
                 break
             except Exception as e:
                 logger.error(f"Error in command interface: {e}")
+        stopped.cancel()
+        if read is not None:
+            read.cancel()
     
     async def shutdown(self) -> None:
         """Shut down the application cleanly."""
+        if self._closing:
+            return
+        self._closing = True
         logger.info("Shutting down BLE agent...")
-        await self.agent.close()
-        # Exit the application
-        asyncio.get_event_loop().stop()
+        try:
+            await self.agent.close()
+        finally:
+            try:
+                await Agent.close_models()
+            finally:
+                # Let the command interface, and with it start(), return
+                self._stop_event.set()
 
 def parse_arguments():
     """Parse command line arguments."""
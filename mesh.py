@@ -5,9 +5,17 @@ This module implements a virtual mesh network where AI agents can communicate
 with simulated latency and basic error handling.
 """
 import asyncio
+import heapq
 import json
 import random
-from typing import Dict, Callable, Any, Optional
+import time
+from collections import OrderedDict
+from typing import Dict, Callable, Any, Optional, List, Set, Tuple
+
+from status_log import log
+
+# Number of recent (sender, receiver, id) keys remembered for deduplication
+DEDUP_CACHE_SIZE = 4096
 
 class MeshNetwork:
     """
@@ -19,7 +27,19 @@ class MeshNetwork:
     def __init__(self):
         """Initialize a new mesh network."""
         self.agents: Dict[str, Callable[[str, dict], None]] = {}
+        # Whether each agent's callback is a coroutine function, checked once at registration
+        self._callback_is_async: Dict[str, bool] = {}
         self.message_counter = 0
+        # Simulated one-way latency per (sender, receiver) link, in seconds
+        self.latency: Dict[Tuple[str, str], float] = {}
+        # Recently sent message keys, oldest first
+        self._seen: "OrderedDict[Tuple[str, str, Any], None]" = OrderedDict()
+        # Messages waiting out their latency, as a heap of
+        # (deadline, message_id, sender, receiver, message, latency)
+        self._pending: List[Tuple[float, int, str, str, dict, float]] = []
+        self._wakeup = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
     
     async def register_agent(self, agent_id: str, callback: Callable[[str, dict], None]) -> None:
         """
@@ -34,19 +54,34 @@ class MeshNetwork:
         """
         if agent_id in self.agents:
             raise ValueError(f"Agent ID '{agent_id}' is already registered")
+        
+        # Give the new agent a fixed, symmetric latency (100-500ms) to every peer
+        for peer_id in self.agents:
+            self.latency[(agent_id, peer_id)] = self.latency[(peer_id, agent_id)] = random.uniform(0.1, 0.5)
         self.agents[agent_id] = callback
-        print(f"[MESH] Agent '{agent_id}' joined the network")
+        self._callback_is_async[agent_id] = asyncio.iscoroutinefunction(callback)
+        log(f"[MESH] Agent '{agent_id}' joined the network")
     
     async def unregister_agent(self, agent_id: str) -> None:
         """Remove an agent from the network."""
         if agent_id in self.agents:
             del self.agents[agent_id]
-            print(f"[MESH] Agent '{agent_id}' left the network")
+            del self._callback_is_async[agent_id]
+            for peer_id in self.agents:
+                self.latency.pop((agent_id, peer_id), None)
+                self.latency.pop((peer_id, agent_id), None)
+            log(f"[MESH] Agent '{agent_id}' left the network")
     
     async def send(self, sender: str, receiver: str, message: dict) -> None:
         """
         Send a message from one agent to another.
         
+        A message that carries a hashable ``id`` is dropped if the same sender
+        already sent that id to the same receiver recently; unhashable ids
+        are not deduplicated. A message that carries a
+        ``ttl`` is dropped once it reaches zero, and is delivered with its
+        ``ttl`` reduced by one.
+        
         Args:
             sender: ID of the sending agent
             receiver: ID of the receiving agent
@@ -58,42 +93,108 @@ class MeshNetwork:
         if receiver not in self.agents:
             raise KeyError(f"Receiver '{receiver}' not found in the network")
         
+        # Drop messages that have used up their hops
+        ttl = message.get('ttl')
+        if ttl is not None and ttl <= 0:
+            return
+        
+        # Drop repeats of a message we already sent on this link
+        if 'id' in message:
+            key = (sender, receiver, message['id'])
+            try:
+                seen = key in self._seen
+            except TypeError:
+                # Unhashable id (e.g. a list); deliver without deduplicating
+                pass
+            else:
+                if seen:
+                    self._seen.move_to_end(key)
+                    return
+                self._seen[key] = None
+                if len(self._seen) > DEDUP_CACHE_SIZE:
+                    self._seen.popitem(last=False)
+        
         # Add metadata to message
         message_id = self.message_counter
         self.message_counter += 1
         
-        # Simulate network latency (100-500ms)
-        latency = random.uniform(0.1, 0.5)
+        # Simulate network latency (100-500ms); links between registered agents
+        # have a fixed latency, anything else gets a random one
+        latency = self.latency.get((sender, receiver))
+        if latency is None:
+            latency = random.uniform(0.1, 0.5)
+        
+        # Hand the message to the flusher, which delivers it once its
+        # latency has passed
+        heapq.heappush(self._pending, (time.monotonic() + latency, message_id, sender, receiver, message, latency))
+        self._wakeup.set()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_pending())
+    
+    async def _flush_pending(self) -> None:
+        """
+        Deliver pending messages as their simulated latency runs out.
+        
+        One task sleeps until the earliest deadline instead of one sleeping
+        task per message; every message due by then is delivered together.
         
-        # Create a task to handle the message with simulated latency
-        asyncio.create_task(self._deliver_message(sender, receiver, message, message_id, latency))
+        This is an internal method and should not be called directly.
+        """
+        while True:
+            self._wakeup.clear()
+            if not self._pending:
+                await self._wakeup.wait()
+                continue
+            
+            # Sleep until the earliest delivery is due, or a new message arrives
+            timeout = self._pending[0][0] - time.monotonic()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            now = time.monotonic()
+            due = []
+            while self._pending and self._pending[0][0] <= now:
+                _, message_id, sender, receiver, message, latency = heapq.heappop(self._pending)
+                due.append(self._deliver_message(sender, receiver, message, message_id, latency))
+            
+            # Run the receivers' callbacks concurrently so a slow one
+            # doesn't hold up later deliveries
+            delivery = asyncio.ensure_future(asyncio.gather(*due))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
     
     async def _deliver_message(self, sender: str, receiver: str, message: dict, 
                              message_id: int, delay: float) -> None:
         """
-        Deliver a message after a simulated network delay.
+        Deliver a message whose simulated network delay has passed.
         
         This is an internal method and should not be called directly.
         """
         try:
-            # Wait for the simulated network delay
-            await asyncio.sleep(delay)
-            
             # Get the receiver's callback
             callback = self.agents.get(receiver)
             if callback:
-                # Create a copy of the message to prevent modification
-                message_copy = message.copy()
-                message_copy['message_id'] = message_id
-                message_copy['timestamp'] = asyncio.get_event_loop().time()
+                # Build the receiver's copy with its metadata in one allocation,
+                # so the sender's dict is never modified
+                message_copy = {**message, 'message_id': message_id, 'timestamp': time.monotonic()}
+                if 'ttl' in message:
+                    message_copy['ttl'] = message['ttl'] - 1
                 
-                # Call the receiver's callback
-                await callback(sender, message_copy)
-                print(f"[MESH] Message {message_id} delivered from '{sender}' to '{receiver}' "
-                      f"(latency: {delay*1000:.0f}ms)")
+                # Call the receiver's callback; plain functions are called
+                # directly rather than through an extra coroutine
+                if self._callback_is_async[receiver]:
+                    await callback(sender, message_copy)
+                else:
+                    callback(sender, message_copy)
+                log(f"[MESH] Message {message_id} delivered from '{sender}' to '{receiver}' "
+                    f"(latency: {delay*1000:.0f}ms)")
             
         except Exception as e:
-            print(f"[MESH] Error delivering message {message_id}: {e}")
+            log(f"[MESH] Error delivering message {message_id}: {e}")
     
     def get_agent_count(self) -> int:
         """Return the number of agents currently in the network."""
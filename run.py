@@ -7,7 +7,7 @@ communicating with each other.
 import asyncio
 import signal
 import sys
-from typing import List
+from typing import List, Optional
 
 from mesh import MeshNetwork
 from agent import Agent
@@ -15,10 +15,16 @@ from agent import Agent
 # Global variables for cleanup
 agents: List[Agent] = []
 
+# Set by the signal handler to end the demo; created once the loop is running
+stop_event: Optional[asyncio.Event] = None
+
 async def main():
     """Main entry point for the demo."""
     print("=== Bluetooth Mesh AI Agents Demo ===\n")
     
+    global stop_event
+    stop_event = asyncio.Event()
+    
     # Create the mesh network
     mesh = MeshNetwork()
     
@@ -37,40 +43,39 @@ async def main():
         
         print("\n=== Starting Conversation ===")
         
-        # Start a conversation about Toronto's weather
-        await alice.start_conversation("Bob", "Hey Bob, have you checked the weather in Toronto today? I heard it's quite unpredictable this time of year.")
-        
-        # Wait a bit for the conversation to progress
-        await asyncio.sleep(2)
-        
-        # Bob responds about the weather
-        await bob.start_conversation("Alice", "Hi Alice! Yes, I just saw the forecast. It's currently 18°C with a mix of sun and clouds. Perfect weather for a walk by the lake!")
-        
-        # Wait a bit more
-        await asyncio.sleep(2)
-        
-        # Charlie joins the conversation
-        await charlie.start_conversation("Alice", "Hi Alice and Bob! I just checked the forecast for Toronto. They're predicting a high of 22°C today with a 20% chance of rain in the evening.")
+        # Start the conversations about Toronto's weather all at once;
+        # the mesh already simulates network latency between agents
+        await asyncio.gather(
+            alice.start_conversation("Bob", "Hey Bob, have you checked the weather in Toronto today? I heard it's quite unpredictable this time of year."),
+            # Bob responds about the weather
+            bob.start_conversation("Alice", "Hi Alice! Yes, I just saw the forecast. It's currently 18°C with a mix of sun and clouds. Perfect weather for a walk by the lake!"),
+            # Charlie joins the conversation
+            charlie.start_conversation("Alice", "Hi Alice and Bob! I just checked the forecast for Toronto. They're predicting a high of 22°C today with a 20% chance of rain in the evening."),
+        )
         
         # Let the conversation continue naturally
         await asyncio.sleep(1)
         
         # Keep the program running
         print("\n=== Agents are chatting (Press Ctrl+C to exit) ===")
-        while True:
-            await asyncio.sleep(1)
+        await stop_event.wait()
             
     except asyncio.CancelledError:
         print("\nShutting down...")
     finally:
         # Clean up all agents
-        for agent in agents:
-            await agent.close()
+        try:
+            for agent in agents:
+                await agent.close()
+        finally:
+            await Agent.close_models()
         print("All agents have been shut down.")
 
 async def shutdown(signal, loop):
     """Handle shutdown gracefully."""
     print(f"Received exit signal {signal.name}...")
+    if stop_event is not None:
+        stop_event.set()
     tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
     
     for task in tasks:
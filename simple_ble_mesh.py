@@ -4,15 +4,33 @@ Simple BLE Mesh Implementation for Windows
 This is a simplified version that works reliably on Windows using Bleak.
 """
 import asyncio
-import json
+import functools
 import uuid
-from typing import Dict, Callable, Any, Optional, List
+from collections import OrderedDict
+from typing import Dict, Callable, Any, Optional, List, Set, Tuple
 
 from bleak import BleakScanner, BleakClient, BleakGATTCharacteristic
 
-# BLE Service and Characteristic UUIDs
-SERVICE_UUID = "0000ffe0-0000-1000-8000-00805f9b34fb"
-MESSAGE_CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+from ble_wire import (
+    DEFAULT_CHUNK_SIZE, MESSAGE_CHAR_UUID, NAME_PREFIX, NAME_PREFIX_LEN,
+    encode_frame, negotiate_mtu, reassemble, spawn_callback, write_payload
+)
+from status_log import flush as flush_log, log
+
+# Pause between scans; it backs off while no new peers turn up
+SCAN_INTERVAL = 5.0
+MAX_SCAN_INTERVAL = 60.0
+
+# Addresses whose advertised name is remembered between scans; random
+# addresses rotate, so the oldest are forgotten past this many
+KNOWN_ADDR_CACHE_SIZE = 256
+
+# Most BLE handshakes run at once; more than a few at a time tends to fail
+MAX_CONCURRENT_CONNECTS = 4
+
+# Outbound messages that may wait per peer, and how many go out per write burst
+SEND_QUEUE_SIZE = 64
+MAX_SEND_BATCH = 8
 
 class SimpleBLEMesh:
     """A simplified BLE mesh implementation for Windows."""
@@ -20,18 +38,35 @@ class SimpleBLEMesh:
     def __init__(self, agent_id: str):
         self.agent_id = agent_id
         self.callbacks: Dict[str, Callable[[str, dict], None]] = {}
+        self._callback_is_async: Dict[str, bool] = {}  # Whether each callback is a coroutine function
         self.connected_devices: Dict[str, BleakClient] = {}
+        self._mtu: Dict[str, int] = {}  # Usable write payload size per peer
+        self._addr_to_peer_id: Dict[str, str] = {}
+        self._rx_buffers: Dict[str, bytearray] = {}  # Partial messages per peer address
+        self._callback_tasks: Set[asyncio.Task] = set()  # Coroutine callbacks still running
+        self._send_queues: Dict[str, asyncio.Queue] = {}  # Encoded frames waiting per peer
+        self._writers: Dict[str, asyncio.Task] = {}
+        self._send_closed: Dict[str, asyncio.Event] = {}  # Set when a peer's queue is abandoned
+        # Frames encoded during the current loop iteration, by id(message);
+        # the message is kept alongside so its id can't be reused meanwhile
+        self._frame_cache: Dict[int, Tuple[dict, bytes]] = {}
         self.running = False
-        self.local_name = f"AgentMesh-{agent_id}"
+        self._connect_sema = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+        self._scan_interval = SCAN_INTERVAL
+        # Last advertised name per address and the peer ID parsed from it (None
+        # for non-mesh devices), least recently seen first
+        self._known_addrs: "OrderedDict[str, Tuple[str, Optional[str]]]" = OrderedDict()
+        self.local_name = NAME_PREFIX + agent_id
     
     def register_callback(self, message_type: str, callback: Callable[[str, dict], None]):
         """Register a callback for a specific message type."""
         self.callbacks[message_type] = callback
+        self._callback_is_async[message_type] = asyncio.iscoroutinefunction(callback)
     
     async def start(self):
         """Start the BLE mesh."""
         self.running = True
-        print(f"[BLE] Starting BLE mesh as {self.local_name}")
+        log(f"[BLE] Starting BLE mesh as {self.local_name}")
         
         # Start scanning for other devices
         asyncio.create_task(self._scan_loop())
@@ -39,45 +74,152 @@ class SimpleBLEMesh:
     async def stop(self):
         """Stop the BLE mesh."""
         self.running = False
-        for client in self.connected_devices.values():
+        for task in self._writers.values():
+            task.cancel()
+        self._writers.clear()
+        self._send_queues.clear()
+        for closed in self._send_closed.values():
+            closed.set()
+        self._send_closed.clear()
+        # Disconnecting fires _on_disconnect, which removes the peer from the dict
+        for client in list(self.connected_devices.values()):
             if client.is_connected:
                 await client.disconnect()
+        self._addr_to_peer_id.clear()
+        self._rx_buffers.clear()
+        flush_log()
     
     async def send_message(self, target_id: str, message: dict):
-        """Send a message to a specific agent."""
-        if target_id in self.connected_devices:
-            client = self.connected_devices[target_id]
+        """
+        Send a message to a specific agent.
+        
+        The encoded frame is reused for the rest of the loop iteration, so a
+        message dict must not be changed between sends within one iteration.
+        """
+        queue = self._send_queues.get(target_id)
+        if queue is None:
+            return
+        # The peer's writer sends it
+        frame = self._encode(message)
+        try:
+            queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Wait for room, unless the connection goes away first
+            closed = self._send_closed[target_id]
+            put = asyncio.ensure_future(queue.put(frame))
+            gone = asyncio.ensure_future(closed.wait())
+            await asyncio.wait({put, gone}, return_when=asyncio.FIRST_COMPLETED)
+            put.cancel()
+            gone.cancel()
+            if closed.is_set():
+                log(f"[ERROR] Dropped message to {target_id}: disconnected")
+                return
+        log(f"[SENT to {target_id}] {message.get('content', '')}")
+    
+    def _encode(self, message: dict) -> bytes:
+        """
+        Frame a message, reusing the frame when it is fanned out to several peers.
+        
+        Frames are looked up by the message object, not its contents: a dict
+        changed after being sent in this loop iteration still gets the old
+        frame. Send a new dict instead.
+        """
+        cached = self._frame_cache.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        frame = encode_frame(message)
+        if not self._frame_cache:
+            # Forget the cache once this loop iteration is over
+            asyncio.get_running_loop().call_soon(self._frame_cache.clear)
+        self._frame_cache[id(message)] = (message, frame)
+        return frame
+    
+    async def _writer(self, peer_id: str, client: BleakClient, queue: asyncio.Queue):
+        """Write queued frames to one peer, a batch at a time."""
+        while True:
+            frames = [await queue.get()]
+            while len(frames) < MAX_SEND_BATCH and not queue.empty():
+                frames.append(queue.get_nowait())
+            message_bytes = b''.join(frames)
+            
             try:
-                if client.is_connected:
-                    message_str = json.dumps(message)
-                    # Send in chunks of 20 bytes (BLE MTU)
-                    for i in range(0, len(message_str), 20):
-                        chunk = message_str[i:i+20].encode('utf-8')
-                        await client.write_gatt_char(MESSAGE_CHAR_UUID, chunk)
-                    print(f"[SENT to {target_id}] {message.get('content', '')}")
+                await write_payload(client, message_bytes, self._mtu.get(peer_id, DEFAULT_CHUNK_SIZE))
             except Exception as e:
-                print(f"[ERROR] Failed to send to {target_id}: {e}")
-                if target_id in self.connected_devices:
-                    del self.connected_devices[target_id]
+                log(f"[ERROR] Failed to send to {peer_id}: {e}")
+                self._forget_peer(peer_id, client)
+                # Drop the link too, so the next scan reconnects cleanly
+                try:
+                    await client.disconnect()
+                except Exception as e:
+                    log(f"[ERROR] Failed to disconnect from {peer_id}: {e}")
+                return
+    
+    def _forget_peer(self, peer_id: str, client: BleakClient):
+        """Drop all state kept for a peer's connection."""
+        if self.connected_devices.get(peer_id) is client:
+            del self.connected_devices[peer_id]
+            self._mtu.pop(peer_id, None)
+            self._send_queues.pop(peer_id, None)
+            # Wake any sender still waiting for room in the dropped queue
+            closed = self._send_closed.pop(peer_id, None)
+            if closed is not None:
+                closed.set()
+            writer = self._writers.pop(peer_id, None)
+            if writer is not None and writer is not asyncio.current_task():
+                writer.cancel()
+        self._addr_to_peer_id.pop(client.address, None)
+        self._rx_buffers.pop(client.address, None)
     
     async def _scan_loop(self):
         """Continuously scan for other BLE devices."""
         while self.running:
             try:
-                print("[BLE] Scanning for devices...")
+                log("[BLE] Scanning for devices...")
                 devices = await BleakScanner.discover(timeout=5.0)
                 
+                new_peers = {}
                 for device in devices:
-                    if device.name and device.name.startswith("AgentMesh-"):
-                        peer_id = device.name.split("-", 1)[1]
-                        if peer_id != self.agent_id and peer_id not in self.connected_devices:
-                            print(f"[BLE] Found peer: {peer_id}")
-                            await self._connect_to_peer(peer_id, device.address)
+                    # Only parse a name when an address shows up with a new one
+                    name = device.name
+                    cached = self._known_addrs.get(device.address)
+                    if cached is not None and (not name or name == cached[0]):
+                        # The name can be missing if the scan response was missed
+                        peer_id = cached[1]
+                        self._known_addrs.move_to_end(device.address)
+                    elif name:
+                        if name.startswith(NAME_PREFIX):
+                            peer_id = name[NAME_PREFIX_LEN:]
+                        else:
+                            peer_id = None
+                        self._known_addrs[device.address] = (name, peer_id)
+                        self._known_addrs.move_to_end(device.address)
+                        if len(self._known_addrs) > KNOWN_ADDR_CACHE_SIZE:
+                            self._known_addrs.popitem(last=False)
+                    else:
+                        # Names often arrive only with the scan response; look
+                        # at this address again on the next scan
+                        continue
+                    
+                    if peer_id and peer_id != self.agent_id and peer_id not in self.connected_devices:
+                        log(f"[BLE] Found peer: {peer_id}")
+                        new_peers[peer_id] = device.address
+                
+                # Scan often while peers are turning up, less often once things settle
+                if new_peers:
+                    self._scan_interval = SCAN_INTERVAL
+                else:
+                    self._scan_interval = min(self._scan_interval * 1.5, MAX_SCAN_INTERVAL)
+                
+                # Connect to new peers concurrently, a few handshakes at a time
+                await asyncio.gather(*(
+                    self._connect_to_peer(peer_id, address)
+                    for peer_id, address in new_peers.items()
+                ))
                 
             except Exception as e:
-                print(f"[ERROR] Scan error: {e}")
+                log(f"[ERROR] Scan error: {e}")
             
-            await asyncio.sleep(5)
+            await asyncio.sleep(self._scan_interval)
     
     async def _connect_to_peer(self, peer_id: str, address: str):
         """Connect to a peer device."""
@@ -85,35 +227,55 @@ class SimpleBLEMesh:
             return
         
         try:
-            print(f"[BLE] Connecting to {peer_id}...")
-            client = BleakClient(address)
-            await client.connect()
-            
-            # Set up notification handler
-            await client.start_notify(MESSAGE_CHAR_UUID, self._notification_handler)
+            client = BleakClient(
+                address,
+                disconnected_callback=functools.partial(self._on_disconnect, peer_id)
+            )
+            async with self._connect_sema:
+                log(f"[BLE] Connecting to {peer_id}...")
+                await client.connect()
+                self._mtu[peer_id] = await negotiate_mtu(client)
+                
+                # Set up notification handler
+                await client.start_notify(
+                    MESSAGE_CHAR_UUID,
+                    functools.partial(self._notification_handler, client.address)
+                )
             
             self.connected_devices[peer_id] = client
-            print(f"[BLE] Connected to {peer_id}")
+            self._addr_to_peer_id[client.address] = peer_id
+            queue = self._send_queues[peer_id] = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+            self._send_closed[peer_id] = asyncio.Event()
+            self._writers[peer_id] = asyncio.create_task(self._writer(peer_id, client, queue))
+            log(f"[BLE] Connected to {peer_id}")
             
         except Exception as e:
-            print(f"[ERROR] Failed to connect to {peer_id}: {e}")
+            log(f"[ERROR] Failed to connect to {peer_id}: {e}")
+            self._mtu.pop(peer_id, None)
+    
+    def _on_disconnect(self, peer_id: str, client: BleakClient):
+        """Forget a peer's connection state when its link drops."""
+        self._forget_peer(peer_id, client)
+        # Look for the peer again soon rather than after a backed-off interval
+        self._scan_interval = SCAN_INTERVAL
+        log(f"[BLE] Disconnected from {peer_id}")
     
-    def _notification_handler(self, sender: BleakGATTCharacteristic, data: bytearray):
-        """Handle incoming BLE notifications."""
+    def _notification_handler(self, address: str, sender: BleakGATTCharacteristic, data: bytearray):
+        """Handle incoming BLE notifications from the peer at ``address``."""
         try:
-            message_str = data.decode('utf-8')
-            message = json.loads(message_str)
+            # Find which peer sent this message
+            peer_id = self._addr_to_peer_id.get(address)
             
-            if 'type' in message and message['type'] in self.callbacks:
-                # Find which peer sent this message
-                peer_id = None
-                for pid, client in self.connected_devices.items():
-                    if client.is_connected and client.address == sender.service.client.address:
-                        peer_id = pid
-                        break
-                
-                if peer_id:
-                    self.callbacks[message['type']](peer_id, message)
+            # Messages can span several notifications; only whole ones are parsed
+            self._dispatch(peer_id, reassemble(self._rx_buffers, address, data))
                     
         except Exception as e:
-            print(f"[ERROR] Notification error: {e}")
+            log(f"[ERROR] Notification error: {e}")
+    
+    def _dispatch(self, peer_id: Optional[str], messages: List[Any]):
+        """Hand decoded messages to their registered callbacks."""
+        for message in messages:
+            if peer_id and 'type' in message and message['type'] in self.callbacks:
+                result = self.callbacks[message['type']](peer_id, message)
+                if self._callback_is_async[message['type']]:
+                    spawn_callback(self._callback_tasks, result)
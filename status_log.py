@@ -0,0 +1,61 @@
+"""
+Buffered Status Output
+
+Status lines from the mesh hot paths are collected here and written to
+stdout together, rather than one print (and stdout lock) per line.
+"""
+import asyncio
+import atexit
+import sys
+from typing import List, Optional
+
+# Buffered lines are written out at most this often; lines beyond
+# LOG_BUFFER_SIZE are dropped until the next flush
+LOG_FLUSH_INTERVAL = 0.05
+LOG_BUFFER_SIZE = 2048
+
+_lines: List[str] = []
+_flush_handle: Optional[asyncio.TimerHandle] = None
+_flush_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def log(line: str) -> None:
+    """
+    Queue a status line for the next batched stdout write.
+
+    Outside a running event loop the line (and anything still buffered)
+    is written straight away.
+
+    Args:
+        line: Text to write, without a trailing newline
+    """
+    global _flush_handle, _flush_loop
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _lines.append(line)
+        flush()
+        return
+
+    if len(_lines) < LOG_BUFFER_SIZE:
+        _lines.append(line)
+    # A handle left over from a loop that has since closed never fires
+    if _flush_handle is None or _flush_loop is not loop:
+        _flush_loop = loop
+        _flush_handle = loop.call_later(LOG_FLUSH_INTERVAL, flush)
+
+
+def flush() -> None:
+    """Write out all buffered status lines in one call."""
+    global _flush_handle, _flush_loop
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = _flush_loop = None
+    if _lines:
+        sys.stdout.write('\n'.join(_lines) + '\n')
+        sys.stdout.flush()
+        _lines.clear()
+
+
+# Don't lose the last lines when the process exits between flushes
+atexit.register(flush)
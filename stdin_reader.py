@@ -0,0 +1,72 @@
+"""
+Stdin Line Reader
+
+Reads lines typed by the user on a daemon thread and hands them to the
+event loop, so waiting for input never blocks the loop or process exit.
+"""
+import asyncio
+import os
+import sys
+import threading
+from typing import Optional
+
+
+class StdinReader:
+    """Line reader for stdin that can be awaited from the event loop."""
+
+    def __init__(self, name: str = 'ble-stdin'):
+        """
+        Initialize the reader.
+
+        Args:
+            name: Name for the reader thread
+        """
+        self.name = name
+        # Lines read so far; None marks the end of input
+        self._lines: asyncio.Queue = asyncio.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    async def readline(self) -> Optional[str]:
+        """
+        Wait for the next line of input.
+
+        Cancelling the wait loses no input; the line stays queued for the
+        next call.
+
+        Returns:
+            Optional[str]: The line without its newline, or None at end of input
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, args=(asyncio.get_running_loop(),),
+                name=self.name, daemon=True
+            )
+            self._thread.start()
+        return await self._lines.get()
+
+    def _run(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Read stdin on the reader thread and queue each line on the loop."""
+        # Read the descriptor directly: a daemon thread blocked inside
+        # sys.stdin holds its buffer lock, which aborts interpreter shutdown
+        fd = sys.stdin.fileno()
+        pending = b''
+        while True:
+            try:
+                chunk = os.read(fd, 4096)
+            except OSError:
+                chunk = b''
+            if chunk:
+                *lines, pending = (pending + chunk).split(b'\n')
+            else:
+                lines = [pending] if pending else []
+            items = [line.decode(errors='replace').rstrip('\r') for line in lines]
+            if not chunk:
+                items.append(None)
+            try:
+                for item in items:
+                    loop.call_soon_threadsafe(self._lines.put_nowait, item)
+            except RuntimeError:
+                # The event loop has closed
+                return
+            if not chunk:
+                return
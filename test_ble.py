@@ -1,5 +1,4 @@
 import asyncio
-import json
 from ble_bridge import BLEBridge
 
 async def main():
@@ -23,8 +22,8 @@ async def main():
 
     try:
         print("BLE Bridge is running. Press Ctrl+C to stop.")
-        while True:
-            await asyncio.sleep(1)
+        # Block until cancelled without waking up periodically
+        await asyncio.Event().wait()
     except KeyboardInterrupt:
         print("\nStopping BLE bridge...")
     finally: